@@ -2,24 +2,40 @@ import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 import warnings
+# route sklearn estimators to the oneDAAL backend when it is installed,
+# this has to be done before sklearn is imported. oneDAAL only runs
+# lloyd KMeans, so elkan is only asked for on stock sklearn
+try:
+    from sklearnex import patch_sklearn
+    patch_sklearn()
+    kmeans_algorithm = "lloyd"
+except ImportError:
+    kmeans_algorithm = "elkan"
 import sklearn.preprocessing as pp
 import sklearn.metrics as skmet
 from sklearn import cluster
 import matplotlib.cm as cm
 from scipy.optimize import curve_fit
 
+try:
+    import numba
+    from numba import njit, prange
+except ImportError:
+    numba = None
 
-def read_data(filename):
+
+def read_data(filename, **kwargs):
     """
     Reads a CSV file and returns a DataFrame.
 
     Parameters:
     filename (str): The path to the CSV file to be read.
+    **kwargs: Extra options passed on to pd.read_csv (e.g. usecols, dtype).
 
     Returns:
     pd.DataFrame: A DataFrame containing the data read from the CSV file.
     """
-    df = pd.read_csv(filename)
+    df = pd.read_csv(filename, **kwargs)
     return df
 
 def polynomial_fit(x, a, b, c, d):
@@ -33,7 +49,86 @@ def polynomial_fit(x, a, b, c, d):
     Returns:
     number or array: The value of the cubic polynomial at x.
     """
-    return a * x**3 + b * x**2 + c * x + d
+    # Horner form: ((a*x + b)*x + c)*x + d
+    return ((a * x + b) * x + c) * x + d
+
+def make_poly_eval(params):
+    """
+    Builds an evaluator of the cubic polynomial with fixed coefficients.
+
+    Parameters:
+    params (list or array): Coefficients a, b, c, d of the polynomial.
+
+    Returns:
+    function: Maps a 1D array x to the polynomial values at x. With numba
+    installed it is compiled with the coefficients baked in as constants.
+    """
+    a, b, c, d = (float(p) for p in params)
+    if numba is None:
+        return lambda x: polynomial_fit(x, a, b, c, d)
+
+    @njit(fastmath=True)
+    def poly_eval(x):
+        out = np.empty_like(x)
+        for i in range(x.size):
+            xi = x[i]
+            out[i] = ((a * xi + b) * xi + c) * xi + d
+        return out
+
+    return poly_eval
+
+def polynomial_fit_jac(x):
+    """
+    Calculates the partial derivatives of the cubic polynomial
+    with respect to its coefficients.
+
+    Parameters:
+    x (number or array): The value(s) at which the derivatives are evaluated.
+
+    Returns:
+    numpy.ndarray: Array of shape (4, N) holding x**3, x**2, x and 1.
+    """
+    x = np.asarray(x, dtype=float).ravel()
+    x2 = x * x
+    x3 = x2 * x
+    return np.stack([x3, x2, x, np.ones_like(x)])
+
+def poly_jac(x, a, b, c, d):
+    """
+    Jacobian of the cubic polynomial in the layout used by curve_fit.
+
+    Parameters:
+    x (array): The value(s) at which the Jacobian is evaluated.
+    a, b, c, d (number): Coefficients of the cubic polynomial (unused,
+    the cubic is linear in its coefficients).
+
+    Returns:
+    numpy.ndarray: Array of shape (N, 4) holding x**3, x**2, x and 1.
+    """
+    return polynomial_fit_jac(x).T
+
+if numba is not None:
+    @njit(parallel=True, fastmath=True)
+    def accumulate_var(jac, cov_matrix):
+        """
+        Accumulates the variance sum_ij J[i]*J[j]*C[i,j] for every point.
+
+        Parameters:
+        jac (array): Jacobian of shape (P, N) w.r.t. the P parameters.
+        cov_matrix (array): The (P, P) covariance matrix of the parameters.
+
+        Returns:
+        numpy.ndarray: The variance at each of the N points.
+        """
+        num_par, num_pts = jac.shape
+        out = np.empty(num_pts)
+        for n in prange(num_pts):
+            s = 0.0
+            for i in range(num_par):
+                for j in range(num_par):
+                    s += jac[i, n] * jac[j, n] * cov_matrix[i, j]
+            out[n] = s
+        return out
 
 def error_range(x, f, params, cov_matrix):
     """
@@ -48,13 +143,20 @@ def error_range(x, f, params, cov_matrix):
     Returns:
     numpy.ndarray: The calculated error values corresponding to each x.
     """
-    var = np.zeros_like(x)
-    for i in range(len(params)):
-        deriv1 = derivative(x, f, params, i)
-        for j in range(len(params)):
-            deriv2 = derivative(x, f, params, j)
-            var += deriv1 * deriv2 * cov_matrix[i, j]
-    return np.sqrt(var)
+    x = np.asarray(x, dtype=float)
+    if f is polynomial_fit:
+        # exact partials for the cubic, no finite differences needed
+        jac = polynomial_fit_jac(x)
+    else:
+        # one derivative per coefficient, stacked into a (P, N) Jacobian
+        jac = np.empty((len(params), x.size))
+        for i in range(len(params)):
+            jac[i] = np.ravel(derivative(x, f, params, i))
+    if numba is not None and f is not polynomial_fit:
+        var = accumulate_var(jac, np.asarray(cov_matrix, dtype=float))
+    else:
+        var = np.einsum('in,ij,jn->n', jac, cov_matrix, jac, optimize=True)
+    return np.sqrt(var).reshape(x.shape)
 
 def derivative(x, f, params, index):
     """
@@ -78,34 +180,52 @@ def derivative(x, f, params, index):
     diff = 0.5 * (f(x, *up) - f(x, *low))
     return diff / (val * abs(params[index]))
 
-def one_silhouette(xy, num_clusters):
+def one_silhouette(xy, num_clusters, dist=None, kmeans=None):
     """
     Computes the silhouette score for a given clustering of 2D data.
 
     Parameters:
     xy (array): 2D data points.
     num_clusters (int): The number of clusters for k-means clustering.
+    dist (array, optional): Precomputed pairwise distance matrix of xy.
+    If given, it is reused instead of recomputing the distances.
+    kmeans (estimator, optional): Clusterer to reuse. Its number of
+    clusters is set to num_clusters before fitting.
 
     Returns:
     float: The silhouette score for the clustering.
     """
-    kmeans = cluster.KMeans(n_clusters=num_clusters, n_init=20)
+    if kmeans is None:
+        kmeans = cluster.KMeans(n_clusters=num_clusters, n_init=5,
+                                algorithm=kmeans_algorithm, random_state=0)
+    else:
+        kmeans.set_params(n_clusters=num_clusters)
     kmeans.fit(xy)
     labels = kmeans.labels_
-    score = skmet.silhouette_score(xy, labels)
+    if dist is None:
+        score = skmet.silhouette_score(xy, labels)
+    else:
+        score = skmet.silhouette_score(dist, labels, metric="precomputed")
     return score
 
 
-data_Fer = read_data("FertilityData.csv")
+#use 1960 and 2020 for clustering, only these columns are parsed
+data_Fer = read_data("FertilityData.csv",
+                     usecols=["Country Name", "1960", "2020"],
+                     dtype={"1960": np.float32, "2020": np.float32})
 print(data_Fer.describe())
-#use 1960 and 2020 for clustering. Countries with one NaN are removed
-data_Fer = data_Fer[(data_Fer["1960"].notna()) & (data_Fer["2020"].notna())]
-data_Fer = data_Fer.reset_index(drop=True)
+# Countries with one NaN are removed
+data_Fer = data_Fer.dropna(subset=["1960", "2020"]).reset_index(drop=True)
 # extract 1960
 change = data_Fer[["Country Name", "1960"]].copy()
-# and calculate the growth over 60 years
-change["Change"] = 100.0/60.0 * (data_Fer["2020"]-
-                                 data_Fer["1960"]) / data_Fer["1960"]
+# and calculate the growth over 60 years in a single buffer
+y60 = data_Fer["1960"].to_numpy()
+y20 = data_Fer["2020"].to_numpy()
+chg = np.empty_like(y60)
+np.subtract(y20, y60, out=chg)
+np.divide(chg, y60, out=chg)
+chg *= 100.0/60.0
+change["Change"] = chg
 warnings.filterwarnings("ignore", category=UserWarning)
 print(change.describe())
 print()
@@ -117,14 +237,14 @@ plt.xlabel("Fertility rate, total (births per woman),1960")
 plt.ylabel("Change per year (%)")
 plt.show()
 
-# create a scaler object
-scaler = pp.RobustScaler()
-# and set up the scaler
-# extract the columns for clustering
-df_ex = change[["1960", "Change"]]
-scaler.fit(df_ex)
-# apply the scaling
-norm = scaler.transform(df_ex)
+# create a scaler object, scaling is done in place on the float32 copy
+scaler = pp.RobustScaler(copy=False)
+# extract the columns for clustering, column-major so that each
+# feature is contiguous for the per-column quantiles of the scaler
+df_ex = np.asfortranarray(
+    change[["1960", "Change"]].to_numpy(dtype=np.float32))
+# set up the scaler and apply the scaling
+norm = scaler.fit_transform(df_ex)
 plt.figure(figsize=(8, 8))
 plt.scatter(norm[:, 0], norm[:, 1])
 plt.xlabel("Fertility rate, total (births per woman),1960")
@@ -132,20 +252,26 @@ plt.ylabel("Change per year (%)")
 plt.show()
 
 
+# one clusterer is set up and reused for all the fits below, including
+# the silhouette sweep (it takes the place of MiniBatchKMeans there)
+kmeans = cluster.KMeans(n_init=5, algorithm=kmeans_algorithm, random_state=0)
+
 #calculate silhouette score for 2 to 10 clusters
+# the pairwise distances do not depend on k, compute them once
+dist = skmet.pairwise_distances(norm)
 for ic in range(2, 11):
-    score = one_silhouette(norm, ic)
+    score = one_silhouette(norm, ic, dist, kmeans)
     print(f"The silhouette score for {ic: 3d} is {score: 7.4f}")
 
-# set up the clusterer with the number of expected clusters
-kmeans = cluster.KMeans(n_clusters=3, n_init=20)
+# set the clusterer to the number of expected clusters
+kmeans.set_params(n_clusters=3)
 # Fit the data, results are stored in the kmeans object
 kmeans.fit(norm) # fit done on x,y pairs
 # extract cluster labels
 labels = kmeans.labels_
-# extract the estimated cluster centres and convert to original scales
-cen = kmeans.cluster_centers_
-cen = scaler.inverse_transform(cen)
+# extract the estimated cluster centres and convert to original scales,
+# the scaler works in place so the fitted centres are copied first
+cen = scaler.inverse_transform(kmeans.cluster_centers_.copy())
 xkmeans = cen[:, 0]
 ykmeans = cen[:, 1]
 plt.figure(figsize=(8.0, 8.0))
@@ -161,13 +287,20 @@ plt.show()
 
 print(cen)
 
-change2 = change[labels==0].copy()
-print(change2.describe())
-
-df_ex = change2[["1960", "Change"]]
-scaler.fit(df_ex)
-# apply the scaling
-norm = scaler.transform(df_ex)
+# gather only the two feature columns of the first cluster, stacking
+# them as rows and transposing keeps the result column-major
+mask = labels == 0
+x60 = change["1960"].to_numpy()[mask]
+xch = change["Change"].to_numpy()[mask]
+df_ex = np.stack([x60, xch]).T.astype(np.float32, copy=False)
+# a DataFrame view of the subset is kept only to print the same summary
+# as before, the scaling and plotting below work on the arrays
+print(pd.DataFrame(df_ex, columns=["1960", "Change"]).describe())
+# robust scaling of the subset: median and IQR in one vectorised call
+q25, med, q75 = np.percentile(df_ex, [25, 50, 75], axis=0)
+iqr = q75 - q25
+iqr[iqr == 0.0] = 1.0
+norm = (df_ex - med) / iqr
 plt.figure(figsize=(8, 8))
 plt.scatter(norm[:, 0], norm[:, 1])
 plt.xlabel("Fertility rate, total (births per woman),1960")
@@ -175,20 +308,20 @@ plt.ylabel("Change per year (%)")
 plt.show()
 
 
-# set up the clusterer with the number of expected clusters
-kmeans = cluster.KMeans(n_clusters=3, n_init=20)
+# set the clusterer to the number of expected clusters
+kmeans.set_params(n_clusters=3)
 # Fit the data, results are stored in the kmeans object
 kmeans.fit(norm) # fit done on x,y pairs
 # extract cluster labels
 labels = kmeans.labels_
 # extract the estimated cluster centres and convert to original scales
 cen = kmeans.cluster_centers_
-cen = scaler.inverse_transform(cen)
+cen = cen * iqr + med
 xkmeans = cen[:, 0]
 ykmeans = cen[:, 1]
 plt.figure(figsize=(8.0, 8.0))
 # plot data with kmeans cluster number
-plt.scatter(change2["1960"], change2["Change"], 10,
+plt.scatter(x60, xch, 10,
             labels, marker="o", cmap=cm.rainbow, label='Data Points')
 # show cluster centres
 plt.scatter(xkmeans, ykmeans, 45, "k", marker="d", label='Cluster centera')
@@ -200,46 +333,54 @@ plt.show()
 
 
 # Code for Fitting Europe Arable land Data
-# Load and transpose Europe land data
-Fer_w = read_data('IndData.csv')
-Fer_w_T = Fer_w.T
-
-# Cleaning the transposed data
-Fer_w_T.columns = ['Data']
-Fer_w_T = Fer_w_T.drop('Year')
-Fer_w_T.reset_index(inplace=True)
-Fer_w_T.rename(columns={'index': 'Year'}, inplace=True)
-Fer_w_T['Year'] = Fer_w_T['Year'].astype(int)
-Fer_w_T['Data'] = Fer_w_T['Data'].astype(float)
-
-# Appending to x and y values for modeling
-x_val = Fer_w_T['Year'].values.astype(float)
-y_val = Fer_w_T['Data'].values.astype(float)
+# Load Europe land data: a row of years and a row of values, the first
+# column only holds the row labels and is dropped
+ind_arr = np.genfromtxt('IndData.csv', delimiter=',')[:, 1:]
 
-# Fitting the polynomial model to the data
-popt, pcov = curve_fit(polynomial_fit, x_val, y_val)
-
-# Calculate error ranges for original data
-y_err = error_range(x_val, polynomial_fit, popt, pcov)
+# x and y values for modeling
+x_val = ind_arr[0].astype(np.float64)
+y_val = ind_arr[1].astype(np.float64)
 
-# Predict for future years and predict values
-fut_x = np.arange(max(x_val) + 1, 2041)
-fut_y = polynomial_fit(fut_x, *popt)
+# Center and scale the years so the cubic terms stay of order one,
+# the fit and all predictions are done in these scaled units
+x_mean = x_val.mean()
+x_std = x_val.std()
+xs_val = (x_val - x_mean) / x_std
 
-# Calculate error ranges for predictions
-y_fut_err = error_range(fut_x, polynomial_fit, popt, pcov)
+# Fitting the polynomial model to the data
+popt, pcov = curve_fit(polynomial_fit, xs_val, y_val,
+                       p0=[0.0, 0.0, 0.0, y_val.mean()], jac=poly_jac)
+
+# Future years to predict
+last_year = int(x_val.max()) + 1
+fut_x = np.arange(last_year, 2041, dtype=np.float64)
+fut_xs = (fut_x - x_mean) / x_std
+
+# Evaluate the model and its error range for the original data and the
+# predictions in one pass, then split them again
+all_xs = np.concatenate([xs_val, fut_xs])
+poly_fast = make_poly_eval(popt)
+y_all = poly_fast(all_xs)
+err_all = error_range(all_xs, polynomial_fit, popt, pcov)
+n_val = len(x_val)
+y_fit, fut_y = y_all[:n_val], y_all[n_val:]
+
+# lower and upper limits of the confidence band, written into two
+# buffers that cover both the original data and the predictions
+lo_all = np.empty_like(y_all)
+hi_all = np.empty_like(y_all)
+np.subtract(y_all, err_all, out=lo_all)
+np.add(y_all, err_all, out=hi_all)
 
 # Plotting the fitting data and predicted data
 plt.figure(figsize=(10, 6))
 plt.plot(x_val, y_val, 'g-', label='Actual Data')
-plt.plot(x_val, polynomial_fit(x_val, *popt), 'b-',
-         label='Fitted Model')
-plt.fill_between(x_val, polynomial_fit(x_val, *popt) -
-                 y_err, polynomial_fit(x_val, *popt) + y_err, 
+plt.plot(x_val, y_fit, 'b-', label='Fitted Model')
+plt.fill_between(x_val, lo_all[:n_val], hi_all[:n_val],
                  color='lightblue',alpha=0.5, label='CI for Actual Data')
 plt.plot(fut_x, fut_y, 'b--', label='Future values')
-plt.fill_between(fut_x, fut_y - y_fut_err, fut_y +
-                 y_fut_err, color='lightblue',
+plt.fill_between(fut_x, lo_all[n_val:], hi_all[n_val:],
+                 color='lightblue',
                  alpha=0.5, label='CI for  Future values')
 plt.title('Fitting & Predicting Future for Fertility Rates for Country India')
 plt.xlabel('Year')